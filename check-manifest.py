@@ -1,23 +1,74 @@
 #!/usr/bin/env python
 
 import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import xml.etree.ElementTree as ET
 
 from dataclasses import dataclass, field
-import xml.etree.ElementTree as ET
-from typing import Any, Dict
+from functools import partial
 
+try:
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    HAVE_LXML = False
 
-@dataclass
+
+def make_parser():
+    """
+    Create an XML parser. With lxml, a single parser can be reused for many files.
+    Returns None for the stdlib parser, which makes ET.parse use its default.
+    """
+    if HAVE_LXML:
+        return ET.XMLParser(huge_tree=False, remove_blank_text=True, collect_ids=False)
+    return None
+
+
+def iterparse(source, events):
+    """
+    Incrementally parse an XML file, using the same settings as make_parser.
+    """
+    if HAVE_LXML:
+        return ET.iterparse(source, events=events, remove_blank_text=True, collect_ids=False)
+    return ET.iterparse(source, events=events)
+
+
+def find_files(folder, suffix):
+    """
+    Recursively find files with the given suffix. Unreadable folders are
+    skipped and symlinks to folders are not followed.
+    """
+    found = []
+    subfolders = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subfolders.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    found.append(Path(entry.path))
+    except OSError:
+        return found
+
+    for subfolder in subfolders:
+        found.extend(find_files(subfolder, suffix))
+    return found
+
+
+@dataclass(slots=True)
 class HalRecord:
     """
-    Represents a HAL record with its parsed dictionary form and raw XML.
+    Represents a HAL record. Its canonical XML and parsed dictionary forms are
+    only generated when needed.
     """
     name: str
-    raw_xml: str
     element: ET.Element
-    parsed_data: Dict[str, Any] = field(default_factory=dict)
+    _canonical_xml: bytes = field(default=None, init=False, repr=False)
+    _parsed_data: dict = field(default=None, init=False, repr=False)
 
     @classmethod
     def from_element(cls, element: ET.Element):
@@ -25,12 +76,42 @@ class HalRecord:
         Create a HalRecord from an XML element.
         """
         name = element.findtext("name")
-        raw_xml = ET.tostring(element, encoding="unicode")
-        parsed_data = cls._parse_element_recursively(element)
-        return cls(name=name, raw_xml=raw_xml, element=element, parsed_data=parsed_data)
+        if name is not None:
+            name = sys.intern(name)
+        return cls(name=name, element=element)
+
+    @property
+    def raw_xml(self) -> str:
+        """
+        Serialized element, generated on each access. Only used for debugging.
+        """
+        return ET.tostring(self.element, encoding="unicode")
+
+    @property
+    def canonical_xml(self) -> bytes:
+        """
+        C14N 2.0 form of the element with whitespace around text and comments dropped.
+        """
+        if self._canonical_xml is None:
+            if HAVE_LXML:
+                self._canonical_xml = ET.tostring(self.element, method="c14n2", with_comments=False,
+                                                  strip_text=True, with_tail=False)
+            else:
+                self._canonical_xml = ET.canonicalize(ET.tostring(self.element, encoding="unicode"),
+                                                      strip_text=True).encode()
+        return self._canonical_xml
+
+    @property
+    def parsed_data(self) -> dict:
+        """
+        Element parsed into a dictionary, children are grouped by their tag.
+        """
+        if self._parsed_data is None:
+            self._parsed_data = self._parse_element_recursively(self.element)
+        return self._parsed_data
 
     @staticmethod
-    def _parse_element_recursively(element: ET.Element) -> Dict[str, Any]:
+    def _parse_element_recursively(element: ET.Element) -> dict:
         """
         Recursively parse an XML element into a dictionary.
         """
@@ -63,17 +144,21 @@ class HalRecord:
     def __eq__(self, other):
         """
         Compare two HalRecord objects for semantic equality.
-        Ignores formatting differences.
+        Ignores formatting differences and the order of children with different tags.
         """
         if not isinstance(other, HalRecord):
             return NotImplemented
+        # canonical forms are equal for the most records, the parsed comparison
+        # is only needed when children are ordered differently
+        if self.canonical_xml == other.canonical_xml:
+            return True
         return self.parsed_data == other.parsed_data
 
     def __repr__(self):
         """
         String representation for debugging.
         """
-        return f"HalRecord(name={self.name}, parsed_data={self.parsed_data})"
+        return f"HalRecord(name={self.name}, xml={self.canonical_xml.decode()})"
 
 
 
@@ -81,7 +166,7 @@ def parse_manifest(manifest_path):
     """
     Parse a manifest file and extract its type, version, target-level, and HAL records.
     """
-    tree = ET.parse(manifest_path)
+    tree = ET.parse(str(manifest_path), make_parser())
     root = tree.getroot()
 
     # Extract manifest properties
@@ -100,44 +185,83 @@ def parse_manifest(manifest_path):
     return manifest_tag, manifest_type, manifest_version, target_level, hal_records
 
 
+def load_stock_manifest(manifest_file, tag_to_load, type_to_load):
+    """
+    Load <hal> elements from a single stock manifest.
+
+    Runs in a worker process, so elements are returned serialized. Returns a tuple
+    (manifest_file, status, hals) with status being "loaded", "skipped" if the
+    manifest is of other tag or type, or "failed" on parse error.
+    """
+    try:
+        # Stream the file and keep only <hal> elements, dropping the rest of
+        # the tree as we go. Files of other type are skipped and closed right
+        # after the root element has been read.
+        hals = []
+        with open(manifest_file, "rb") as f:
+            events = iterparse(f, ("start", "end"))
+            _, root = next(events)
+            if root.tag != tag_to_load or root.attrib.get("type") != type_to_load:
+                # lxml reports the start of a truncated root tag as well, the
+                # next event is only reached if the root tag is well-formed
+                next(events)
+                return manifest_file, "skipped", None
+
+            depth = 1
+            for event, elem in events:
+                if event == "start":
+                    depth += 1
+                    continue
+
+                depth -= 1
+                if depth != 1:
+                    continue
+                if elem.tag == "hal":
+                    elem.tail = None
+                    hals.append(ET.tostring(elem))
+                elem.clear()
+                root.remove(elem)
+    except: # ET.ParseError:
+        return manifest_file, "failed", None
+
+    return manifest_file, "loaded", hals
+
+
 def preload_stock_manifests(stock_tree_path, tag_to_load, type_to_load):
     """
     Load all stock manifests into memory, grouped by type.
     """
     stock_manifests = []
     stock_tree_path = Path(stock_tree_path)
+    manifest_files = find_files(stock_tree_path, ".xml")
 
-    for manifest_file in stock_tree_path.rglob("*.xml"):
-        try:
-            tree = ET.parse(manifest_file)
-            root = tree.getroot()
-            manifest_tag = root.tag
-            manifest_type = root.attrib.get("type")
-
-            if manifest_tag != tag_to_load or manifest_type != type_to_load:
+    load = partial(load_stock_manifest, tag_to_load=tag_to_load, type_to_load=type_to_load)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for manifest_file, status, hals in executor.map(load, manifest_files, chunksize=4):
+            if status == "failed":
+                print(f"Warning: Failed to parse {manifest_file}")
+                continue
+            if status == "skipped":
                 continue
 
             print(f"Loading {manifest_file}")
-
-            m = [HalRecord.from_element(hal) for hal in root.findall("hal")]
+            m = [HalRecord.from_element(ET.fromstring(hal)) for hal in hals]
             stock_manifests.append(dict(file=manifest_file, hal_records=m))
-        except: # ET.ParseError:
-            print(f"Warning: Failed to parse {manifest_file}")
-            continue
 
     return stock_manifests
 
 
-def find_matching_hal(stock_manifests, hal_name):
+def build_hal_index(stock_manifests):
     """
-    Find a matching HAL record in the preloaded stock manifests.
+    Index preloaded stock HAL records by name. If the same HAL is declared in
+    several manifests, the first one found is used.
     """
+    hal_index = {}
     for manifest in stock_manifests:
         for srec in manifest["hal_records"]:
-            if hal_name == srec.name:
-                return srec, manifest["file"]
+            hal_index.setdefault(srec.name, (srec, manifest["file"]))
 
-    return None, None
+    return hal_index
 
 
 def combine_elements(my_manifest_path, elements_to_combine, output_path):
@@ -150,20 +274,21 @@ def combine_elements(my_manifest_path, elements_to_combine, output_path):
         output_path (str): Path to the output XML file.
     """
     # Parse my_manifest to get the root
-    my_manifest_tree = ET.parse(my_manifest_path)
+    my_manifest_tree = ET.parse(str(my_manifest_path), make_parser())
     root = my_manifest_tree.getroot()
 
-    # Remove all existing children from the root
-    for child in list(root):
-        root.remove(child)
-
-    # Append new elements from the provided list
-    for element in elements_to_combine:
-        root.append(element)
+    # Replace all existing children of the root by the provided elements
+    root[:] = elements_to_combine
 
     # Write the updated tree to the output file
     tree = ET.ElementTree(root)
-    tree.write(output_path, encoding="utf-8", xml_declaration=True)
+    if HAVE_LXML:
+        # blank text was dropped while parsing, let lxml re-indent the output
+        tree.write(output_path, encoding="utf-8", xml_declaration=True, pretty_print=True)
+    else:
+        # stock elements lost their tails while being passed from the workers
+        ET.indent(tree)
+        tree.write(output_path, encoding="utf-8", xml_declaration=True)
     print(f"Combined XML written to {output_path}")
 
 
@@ -185,13 +310,14 @@ def main(my_manifest, stock_tree, output):
     # Preload all stock manifests
     print("Preloading stock manifests...")
     stock_manifests = preload_stock_manifests(stock_tree_path, my_tag, my_type)
+    hal_index = build_hal_index(stock_manifests)
 
     print()
 
     matched = 0
     elements = []
     for hal in my_hal_records:
-        srec, stock_fname = find_matching_hal(stock_manifests, hal.name)
+        srec, stock_fname = hal_index.get(hal.name, (None, None))
         if srec is None:
             print(f"HAL: {hal.name} - Not found on stock")
             elements.append(hal.element)
@@ -1,27 +1,67 @@
 #!/usr/bin/env python
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
 from pathlib import Path
 import subprocess
 import sys
 
+MODINFO_CACHE = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "lineage-scripts" / "modinfo.json"
+
+
+def load_modinfo_cache():
+    """
+    Load cached module dependencies, keyed by the hash of the module file.
+    """
+    try:
+        with open(MODINFO_CACHE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_modinfo_cache(cache):
+    try:
+        MODINFO_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with open(MODINFO_CACHE, "w") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Warning: Failed to write modinfo cache {MODINFO_CACHE}. {e}")
+
 
 def get_dependencies_with_modinfo(ko_file):
     """
-    Get the dependencies of a .ko file using modinfo.
+    Get the dependencies of a .ko file using modinfo. Raises CalledProcessError if modinfo failed.
+    """
+    result = subprocess.run(
+        ["modinfo", "-F", "depends", str(ko_file)],
+        text=True,
+        capture_output=True,
+        check=True
+    )
+    dependencies = result.stdout.strip()
+    return set(dependencies.split(",")) if dependencies else set()
+
+
+def get_dependencies(ko_file, cache):
     """
+    Get the dependencies of a .ko file, running modinfo only if the file is not in the cache.
+    Returns a tuple (dependencies, error), error is the message to print if modinfo failed.
+    """
+    key = hashlib.blake2b(ko_file.read_bytes(), digest_size=16).hexdigest()
+    if key in cache:
+        return set(cache[key]), None
+
     try:
-        result = subprocess.run(
-            ["modinfo", "-F", "depends", str(ko_file)],
-            text=True,
-            capture_output=True,
-            check=True
-        )
-        dependencies = result.stdout.strip()
-        return set(dependencies.split(",")) if dependencies else set()
+        dependencies = get_dependencies_with_modinfo(ko_file)
     except subprocess.CalledProcessError as e:
-        print(f"Error: Failed to run modinfo on {ko_file}. {e.stderr}")
-        return set()
+        return set(), f"Error: Failed to run modinfo on {ko_file}. {e.stderr}"
+
+    cache[key] = sorted(dependencies)
+    return dependencies, None
 
 
 def validate_modules(ko_folder):
@@ -33,14 +73,24 @@ def validate_modules(ko_folder):
         print(f"Error: {ko_folder} is not a valid directory.")
         sys.exit(1)
 
+    ko_files = sorted(ko_folder.glob("*.ko"))
+
     # Get a set of all available .ko filenames without the extension
-    available_modules = {file.stem for file in ko_folder.glob("*.ko")}
+    available_modules = frozenset(file.stem for file in ko_files)
 
     invalid_modules = []
 
-    for ko_file in sorted(ko_folder.glob("*.ko")):
-        dependencies = get_dependencies_with_modinfo(ko_file)
-        print(f"{ko_file.stem}: {' '.join(sorted(list(dependencies)))}")
+    # modinfo runs as a subprocess, so threads are enough to run it in parallel
+    cache = load_modinfo_cache()
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        results = list(executor.map(lambda f: get_dependencies(f, cache), ko_files))
+    save_modinfo_cache(cache)
+
+    # errors are printed here, in the order of the modules
+    for ko_file, (dependencies, error) in zip(ko_files, results):
+        if error:
+            print(error)
+        print(f"{ko_file.stem}: {' '.join(sorted(dependencies))}")
 
         # Check if any dependency is missing
         missing_dependencies = dependencies - available_modules
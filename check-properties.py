@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 import argparse
+import os
 import pathlib
-import re
+import sys
 from dataclasses import dataclass
 from typing import Optional
 
@@ -35,29 +36,28 @@ def parse_prop_file(file_path):
     """
     prop_lines = []
     
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            
-            # Empty line or line with comment
-            if not line or line.startswith('#'):
-                prop_lines.append(PropLine(is_property=False, line=line, file=file_path))
-                continue
-                        
-            # Property
-            match = re.match(r'^([^=]+)=(.*)$', line)
-            if match:
-                prop, value = match.groups()
-                prop_lines.append(PropLine(
-                    is_property=True, 
-                    property_name=prop.strip(), 
-                    property_value=value.strip(), 
-                    line=line,
-                    file=file_path,
-                ))
-            else:
-                # Unrecognized line type
-                print(f"Failed to parse line in {file_path}: {line}")
+    data = pathlib.Path(file_path).read_text()
+    for line in data.splitlines():
+        line = line.strip()
+        
+        # Empty line or line with comment
+        if not line or line.startswith('#'):
+            prop_lines.append(PropLine(is_property=False, line=line, file=file_path))
+            continue
+                    
+        # Property
+        prop, sep, value = line.partition('=')
+        if sep and prop:
+            prop_lines.append(PropLine(
+                is_property=True, 
+                property_name=sys.intern(prop.strip()), 
+                property_value=value.strip(), 
+                line=line,
+                file=file_path,
+            ))
+        else:
+            # Unrecognized line type
+            print(f"Failed to parse line in {file_path}: {line}")
 
     
     return prop_lines
@@ -88,7 +88,23 @@ def find_prop_files(rom_folder):
     Returns:
         list: List of paths to .prop files
     """
-    return list(rom_folder.rglob('*.prop'))
+    found = []
+    subfolders = []
+    try:
+        with os.scandir(rom_folder) as it:
+            for entry in it:
+                if entry.is_dir():
+                    # as rglob, symlinks to folders are not followed
+                    if not entry.is_symlink():
+                        subfolders.append(entry.path)
+                elif entry.name.endswith('.prop'):
+                    found.append(pathlib.Path(entry.path))
+    except OSError:
+        return found  # unreadable folders are skipped
+
+    for subfolder in subfolders:
+        found.extend(find_prop_files(subfolder))
+    return found
 
 def load_properties_from_files(prop_files):
     """
@@ -119,18 +135,18 @@ def compare_properties(custom_props, stock_props):
     """
     differences = {}
     for prop, custom_value in custom_props.items():
-        if prop in stock_props:
-            stock_value = stock_props[prop]
-            if custom_value != stock_value:
-                differences[prop] = {
-                    'custom': custom_value,
-                    'stock': stock_value
-                }
-        else:
+        # single lookup per property, None marks a property missing in stock
+        stock_value = stock_props.get(prop)
+        if stock_value is None:
             differences[prop] = {
                 'custom': custom_value,
                 'stock': 'NOT_FOUND'
             }
+        elif custom_value != stock_value:
+            differences[prop] = {
+                'custom': custom_value,
+                'stock': stock_value
+            }
     
     return differences
 
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
 import argparse
+from collections import defaultdict, deque
 import re
+import sys
 from dataclasses import dataclass
-from termcolor import cprint
+from termcolor import colored
+
+DIFF_LINE_FORMAT = "{:>6} {:>6} {}"
+OUTPUT_CHUNK_SIZE = 4096
 
 
 @dataclass
@@ -13,94 +18,121 @@ class DiffEntry:
     content: str
 
 
-class Line:
-    def __init__(self, line):
-        self.line = line
-
-    def sub(self, f, t):
-        self.line = re.sub(f, t, self.line)
-
-    def replace(self, o, n):
-        self.line = self.line.replace(o, n)
-
-    def skip(self, *starts):
-        for s in starts:
-            if self.line.startswith(s):
-                return True
-        return False
+# Values in dmesg lines that are replaced by a dummy. Patterns must not
+# contain capturing groups, the group of the match selects the replacement.
+# Patterns must start with a literal character, plain or escaped punctuation
+# such as "\(", it is used to skip positions quickly (checked below).
+DMESG_SUBSTITUTIONS = [
+    (r"audit\([\d.]+:\d+\)", "audit(REPLACED)"),
+    (r" duration=\d+", " duration=REPLACED"),
+    (r"Adding to iommu group \d+", "Adding to iommu group REPLACED"),
+    (r"pid \d+", "pid REPLACED"),
+    (r"pid=\d+", "pid=REPLACED"),
+    (r"pid: \d+", "pid: REPLACED"),
+    (r"pid:\d+", "pid:REPLACED"),
+    (r"PID: \d+", "PID: REPLACED"),
+    (r"\[\d+ \]", "[REPLACED ]"),
+    (r"CPU: \d+", "CPU: R"),
+    (r"Port: \d+", "Port: R"),
+    (r"took \d+.\d+ seconds", "took REPLACED seconds"),
+    (r"took \d+ms", "took REPLACEDms"),
+    (r"took \d+ ms", "took REPLACED ms"),
+]
+
+
+def dmesg_first_char(pattern):
+    """Get the literal first character of a substitution pattern."""
+    if pattern[0] == "\\":
+        char = pattern[1]
+        assert not char.isalnum(), f"pattern must start with a literal character: {pattern}"
+    else:
+        char = pattern[0]
+        assert char not in ".^$*+?{}[]|()", f"pattern must start with a literal character: {pattern}"
+    return char
+
+
+# All substitutions combined into a single pattern, so each line is scanned once.
+# The lookahead on the first characters of the patterns lets the regex engine
+# skip positions quickly, which it cannot do for an alternation of groups.
+DMESG_PATTERN = re.compile(
+    "(?=["
+    + re.escape("".join(sorted({dmesg_first_char(p) for p, _ in DMESG_SUBSTITUTIONS})))
+    + "])(?:"
+    + "|".join(f"({p})" for p, _ in DMESG_SUBSTITUTIONS)
+    + ")"
+)
+DMESG_REPLACEMENTS = [r for _, r in DMESG_SUBSTITUTIONS]
+
+
+def dmesg_replacement(match):
+    return DMESG_REPLACEMENTS[match.lastindex - 1]
 
 
 def preprocess_dmesg(lines):
-    """Preprocess dmesg logs to remove the timing column."""
-    processed = []
+    """Preprocess dmesg logs to remove the timing column, yielding processed lines."""
+    # bound to a local, saves attribute lookups per line
+    sub = DMESG_PATTERN.sub
     for line in lines:
-        line = Line(line.split("]", 2)[-1].strip() if "]" in line else line)
+        line = line.split("]", 2)[-1].strip() if "]" in line else line
 
         # drop unimportant lines
-        if line.skip("healthd: battery l="):
+        if line.startswith("healthd: battery l="):
             continue
 
         # unify some messages
-        line.replace("apexd-bootstrap:", "apexd:")
-        line.replace("/vendor_dlkm/", "/vendor/")
-        line.replace("/system/system_ext", "/system")
-        line.replace(" No alternative instances declared in VINTF.", "")
+        line = line.replace("apexd-bootstrap:", "apexd:")
+        line = line.replace("/vendor_dlkm/", "/vendor/")
+        line = line.replace("/system/system_ext", "/system")
+        line = line.replace(" No alternative instances declared in VINTF.", "")
 
         # replace some values with a dummy
-        line.sub(r"audit\(([\d.]+:\d+)\)", "audit(REPLACED)")
-        line.sub(r" duration=\d+", " duration=REPLACED")
-        line.sub(r"Adding to iommu group \d+", "Adding to iommu group REPLACED")
-        line.sub(r"pid \d+", "pid REPLACED")
-        line.sub(r"pid=\d+", "pid=REPLACED")
-        line.sub(r"pid: \d+", "pid: REPLACED")
-        line.sub(r"pid:\d+", "pid:REPLACED")
-        line.sub(r"PID: \d+", "PID: REPLACED")
-        line.sub(r"\[\d+ \]", "[REPLACED ]")
-        line.sub(r"CPU: \d+", "CPU: R")
-        line.sub(r"Port: \d+", "Port: R")
-        line.sub(r"took \d+.\d+ seconds", "took REPLACED seconds")
-        line.sub(r"took \d+ms", "took REPLACEDms")
-        line.sub(r"took \d+ ms", "took REPLACED ms")
-        processed.append(line.line)
-    return processed
+        yield sub(dmesg_replacement, line)
 
 
 def read_file(filepath):
-    """Read a file and return its lines."""
+    """Read a file and yield its lines."""
     with open(filepath, "r") as f:
-        return f.readlines()
+        yield from f
 
 
 def compare_logs(file1_lines, file2_lines, context=100):
-    """Compare two log files, allowing lines to be matched within a +/- context."""
+    """
+    Compare two log files, allowing lines to be matched within a +/- context.
+    Lines of the first file are consumed lazily and are not kept in memory.
+    """
     result = []
-    used_indices = set()
-
-    for i, line1 in enumerate(file1_lines):
-        found = False
-        start = max(0, i - context)
-        end = min(len(file2_lines), i + context + 1)
-
-        for j in range(start, end):
-            if j in used_indices:
+    stripped2 = [line.strip() for line in file2_lines]
+
+    # Flags of file2 lines that have been matched already
+    matched2 = bytearray(len(stripped2))
+
+    # Line numbers of unmatched lines in file2, per line content, in increasing order
+    index = defaultdict(deque)
+    for j, line2 in enumerate(stripped2):
+        index[line2].append(j)
+
+    for i, line1 in enumerate(map(str.strip, file1_lines)):
+        # Take the first unused line within the context. Lines before the
+        # context can't be matched by any of the following lines either.
+        candidates = index.get(line1)
+        if candidates:
+            while candidates and candidates[0] < i - context:
+                candidates.popleft()
+            if candidates and candidates[0] <= i + context:
+                matched2[candidates.popleft()] = 1
                 continue
-            if line1.strip() == file2_lines[j].strip():
-                used_indices.add(j)
-                found = True
-                break
 
-        if not found:
-            result.append(
-                DiffEntry(
-                    line_number_old=i + 1, line_number_new=-1, content=line1.strip()
-                )
+        result.append(
+            DiffEntry(
+                line_number_old=i + 1, line_number_new=-1, content=line1
             )
+        )
 
-    for i, line2 in enumerate(file2_lines):
-        if i not in used_indices:
+    for i, line2 in enumerate(stripped2):
+        if not matched2[i]:
             result.append(
                 DiffEntry(
-                    line_number_old=-1, line_number_new=i + 1, content=line2.strip()
+                    line_number_old=-1, line_number_new=i + 1, content=line2
                 )
             )
 
@@ -112,6 +144,28 @@ def compare_logs(file1_lines, file2_lines, context=100):
     )
 
 
+def write_diff(diff, color=True):
+    """Write diff entries to stdout, joining them in chunks instead of printing each line."""
+    if color:
+        added_fmt = colored(DIFF_LINE_FORMAT, "green")  # Green for added lines
+        removed_fmt = colored(DIFF_LINE_FORMAT, "light_yellow")  # for removed lines
+    else:
+        added_fmt = removed_fmt = DIFF_LINE_FORMAT
+
+    write = sys.stdout.write
+    for start in range(0, len(diff), OUTPUT_CHUNK_SIZE):
+        lines = []
+        for entry in diff[start : start + OUTPUT_CHUNK_SIZE]:
+            if entry.line_number_old == -1:
+                fmt, old, new = added_fmt, "-", entry.line_number_new
+            elif entry.line_number_new == -1:
+                fmt, old, new = removed_fmt, entry.line_number_old, "-"
+            else:
+                fmt, old, new = DIFF_LINE_FORMAT, entry.line_number_old, entry.line_number_new
+            lines.append(fmt.format(old, new, entry.content))
+        write("\n".join(lines) + "\n")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Compare log files with flexible line matching."
@@ -147,28 +201,7 @@ def main():
     diff = compare_logs(file1_lines, file2_lines, context=args.context)
 
     # Output results
-    for entry in diff:
-        line_number_old = (
-            f"{entry.line_number_old}" if entry.line_number_old != -1 else "-"
-        )
-        line_number_new = (
-            f"{entry.line_number_new}" if entry.line_number_new != -1 else "-"
-        )
-        if args.no_color:
-            print(f"{line_number_old:>6} {line_number_new:>6} {entry.content}")
-        else:
-            if entry.line_number_old == -1:
-                cprint(
-                    f"{line_number_old:>6} {line_number_new:>6} {entry.content}",
-                    "green",
-                )  # Green for added lines
-            elif entry.line_number_new == -1:
-                cprint(
-                    f"{line_number_old:>6} {line_number_new:>6} {entry.content}",
-                    "light_yellow",
-                )  # for removed lines
-            else:
-                print(f"{line_number_old:>6} {line_number_new:>6} {entry.content}")
+    write_diff(diff, color=not args.no_color)
 
 
 if __name__ == "__main__":
@@ -6,8 +6,7 @@ from pathlib import Path
 def loadfiles(path: Path):
     if not path.exists():
         raise RuntimeError(f"Folder does not exist: {path}")
-    files = [str(m.name) for m in path.glob("*.ko")]
-    return sorted(files)
+    return {m.name for m in path.glob("*.ko")}
 
 def main():
     parser = argparse.ArgumentParser(
@@ -28,19 +27,16 @@ def main():
     custom = loadfiles(custom_module_path)
 
     # compare sizes
-    for s in stock:
-        if s in custom:
-            ss = (stock_module_path / s).stat().st_size
-            cs = (custom_module_path / s).stat().st_size
-            print(f"Module sizes: {s} -- {ss} vs {cs}")
-
-    for s in stock:
-        if s not in custom:
-            print(f"Custom ROM is missing: {s}")
-
-    for c in custom:
-        if c not in stock:
-            print(f"Custom ROM has extra module: {c}")
+    for s in sorted(stock & custom):
+        ss = (stock_module_path / s).stat().st_size
+        cs = (custom_module_path / s).stat().st_size
+        print(f"Module sizes: {s} -- {ss} vs {cs}")
+
+    for s in sorted(stock - custom):
+        print(f"Custom ROM is missing: {s}")
+
+    for c in sorted(custom - stock):
+        print(f"Custom ROM has extra module: {c}")
     
 
 
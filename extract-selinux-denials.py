@@ -1,7 +1,22 @@
 #!/usr/bin/env python
  
 import argparse
+import mmap
+import os
 import re
+from contextlib import nullcontext
+
+AVC_PATTERN = re.compile(
+    rb'avc:  denied  \{[^}\n]+\} for [^\n]*?'
+    rb'scontext=\S+ tcontext=\S+ tclass=\S+ permissive=\d'
+)
+
+DENIAL_PATTERN = re.compile(
+    r"\{\s*(?P<perms>[^}]+?)\s*\}.*?"
+    r"scontext=(?P<scontext>\S+)\s+tcontext=(?P<tcontext>\S+)\s+tclass=(?P<tclass>\S+)"
+)
+ROLE_PATTERN = re.compile(r":r:([^:]+):")
+OBJECT_PATTERN = re.compile(r":object_r:([^:]+):")
 
 class SELinuxPolicyGenerator:
     def __init__(self):
@@ -12,36 +27,13 @@ class SELinuxPolicyGenerator:
         
     def parse_denial(self, denial_string):
         """Parse a SELinux denial string and add it to the policy compilation."""
-        # Extract the permission(s)
-        permission_start = denial_string.find("{ ") + 2
-        permission_end = denial_string.find(" }", permission_start)
-        if permission_start < 2 or permission_end < 0:
-            raise ValueError("Invalid denial string format: couldn't find permission")
-        permissions = denial_string[permission_start:permission_end].split()
-        
-        # Extract scontext
-        scontext_start = denial_string.find("scontext=") + 9
-        scontext_end = denial_string.find(" ", scontext_start)
-        if scontext_start < 9 or scontext_end < 0:
-            raise ValueError("Invalid denial string format: couldn't find scontext")
-        scontext = denial_string[scontext_start:scontext_end]
-        
-        # Extract tcontext
-        tcontext_start = denial_string.find("tcontext=") + 9
-        tcontext_end = denial_string.find(" ", tcontext_start)
-        if tcontext_start < 9 or tcontext_end < 0:
-            raise ValueError("Invalid denial string format: couldn't find tcontext")
-        tcontext = denial_string[tcontext_start:tcontext_end]
-        
-        # Extract tclass
-        tclass_start = denial_string.find("tclass=") + 7
-        tclass_end = denial_string.find(" ", tclass_start)
-        if tclass_start < 7:
-            raise ValueError("Invalid denial string format: couldn't find tclass")
-        if tclass_end < 0:  # Might be the end of the string
-            tclass = denial_string[tclass_start:]
-        else:
-            tclass = denial_string[tclass_start:tclass_end]
+        match = DENIAL_PATTERN.search(denial_string)
+        if match is None:
+            raise ValueError(f"Invalid denial string format: {denial_string}")
+        permissions = match["perms"].split()
+        scontext = match["scontext"]
+        tcontext = match["tcontext"]
+        tclass = match["tclass"]
         
         # Create a key for the denial dictionary
         key = (scontext, tcontext, tclass)
@@ -60,20 +52,12 @@ class SELinuxPolicyGenerator:
         
         for (scontext, tcontext, tclass), permissions in self.denials.items():
             # Extract the role from scontext (the part between first and second colon)
-            role_start = scontext.find(":r:") + 3
-            role_end = scontext.find(":", role_start)
-            if role_start < 3 or role_end < 0:
-                role = scontext  # Fallback if we can't extract role
-            else:
-                role = scontext[role_start:role_end]
+            match = ROLE_PATTERN.search(scontext)
+            role = match[1] if match else scontext  # Fallback if we can't extract role
                 
             # Extract object type from tcontext (the part between second and third colon)
-            obj_start = tcontext.find(":object_r:") + 10
-            obj_end = tcontext.find(":", obj_start)
-            if obj_start < 10 or obj_end < 0:
-                obj = tcontext  # Fallback if we can't extract object type
-            else:
-                obj = tcontext[obj_start:obj_end]
+            match = OBJECT_PATTERN.search(tcontext)
+            obj = match[1] if match else tcontext  # Fallback if we can't extract object type
             
             # Format the policy rule
             permission_str = " ".join(sorted(permissions))
@@ -95,51 +79,59 @@ class SELinuxPolicyGenerator:
 
 
 
+def map_log(f):
+    """Map the log read-only, mmap refuses empty files."""
+    if os.fstat(f.fileno()).st_size == 0:
+        return nullcontext(b"")
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 def extract_unique_denials(log_file, output_file, verbose):
     avc_denials = dict()
     
-    avc_pattern = re.compile(r'avc:  denied  \{.*?\} for .*?scontext=.*? tcontext=.*? tclass=.*? permissive=\d')
-    
-    with open(log_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            match = avc_pattern.search(line)
-            if match:
-                record = {}
-                for s in match.group(0).split():
-                    k = s.split("=", maxsplit=2)
-                    if len(k) > 1:
-                        record[k[0]] = k[1]
-                    else:
-                        record[k[0]] = None
-                
-                # check if we want to handle this record or just ignore it
-                if record.get("path", "").startswith('"/dev/__properties__/u:object_r:') and \
-                    record.get("scontext", "") == "u:r:hal_camera_default:s0":
-                    continue # skip
-                if record.get("path", "").startswith('"/dev/__properties__/u:object_r:') and \
-                    record.get("scontext", "") == "u:r:odrefresh:s0":
-                    continue # skip
+    with open(log_file, 'rb') as f, map_log(f) as log:
+        for match in AVC_PATTERN.finditer(log):
+            record = {}
+            for s in match.group(0).decode('utf-8').split():
+                k = s.split("=", maxsplit=2)
+                if len(k) > 1:
+                    record[k[0]] = k[1]
+                else:
+                    record[k[0]] = None
+            
+            # check if we want to handle this record or just ignore it
+            if record.get("path", "").startswith('"/dev/__properties__/u:object_r:') and \
+                record.get("scontext", "") == "u:r:hal_camera_default:s0":
+                continue # skip
+            if record.get("path", "").startswith('"/dev/__properties__/u:object_r:') and \
+                record.get("scontext", "") == "u:r:odrefresh:s0":
+                continue # skip
 
-                for k in ["pid", "uid", "ino"]:
-                    record.pop(k, None)
-                
-                key = []
-                for k, v in record.items():
-                    if v is not None:
-                        key.append(f"{k}={v}")
-                    else:
-                        key.append(k)
-                
-                key = " ".join(key)
-                if key not in avc_denials:
-                    avc_denials[key] = line
+            for k in ["pid", "uid", "ino"]:
+                record.pop(k, None)
+            
+            # dedup on the tokens themselves, the key string is only
+            # built once per unique denial
+            key = tuple(record.items())
+            if key not in avc_denials:
+                # only the first occurrence is kept, decode its full line
+                start = log.rfind(b"\n", 0, match.start()) + 1
+                end = log.find(b"\n", match.end())
+                if end < 0:
+                    end = len(log)
+                avc_denials[key] = log[start:end].decode('utf-8')
     
+    unique = {}
+    for record, line in avc_denials.items():
+        key = " ".join(k if v is None else f"{k}={v}" for k, v in record)
+        unique.setdefault(key, line)
+
     with open(output_file, 'w', encoding='utf-8') as f:
-        keys = sorted(avc_denials.keys())
+        keys = sorted(unique.keys())
         denials = [k for k in keys]
         for k in keys:
             if verbose:
-                s = avc_denials[k].strip()
+                s = unique[k].strip()
             else:
                 s = k
             f.write(s + "\n")
@@ -12,9 +12,10 @@ def check_files(device_folders, files):
         with open(os.path.join(txt_file, "proprietary-files.txt"), 'r') as f:
             for line in f:
                 line = line.strip()
-                if not line or line.startswith("#") or \
-                   line.find(";") > 0 or line in files or \
-                   (line.startswith("-") and line[1:] in files) :
+                # cheapest checks first, line is not empty after the first one
+                if not line or line[0] == "#" or \
+                   (line[0] != ";" and ";" in line) or line in files or \
+                   (line[0] == "-" and line[1:] in files) :
                     all_lines.append(line)
                 else:
                     print("Missing in the system:", line)
@@ -1,18 +1,35 @@
 #!/usr/bin/env python
 
 import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import difflib
+from functools import partial
 import hashlib
+import heapq
+import mmap
+import os
 import re
 import shutil
+import threading
 import time
 from pathlib import Path
 from git import Repo, InvalidGitRepositoryError
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 Messages = []
 FilesWithoutMatch = []
 FilesMissing = []
 
+NULL_SHA = "0" * 40  # blob id of a removed file in git log --raw
+MMAP_MIN_SIZE = 64 * 1024
+_thread_data = threading.local()
+
 
 def print_result(message):
     """Print and store the result message."""
@@ -20,14 +37,94 @@ def print_result(message):
     Messages.append(message)
 
 
-def is_git_related(path):
-    return ".git" in path.parts
+def walk_tree(root):
+    """
+    Walk directory tree once, skipping .git and unreadable folders. Returns
+    (relative_path, is_dir) tuples of all directories and files, sorted by path.
+    File type is taken from the cached DirEntry.
+    """
+    items = []
+
+    def walk(folder, relative):
+        try:
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+        # entries of each folder are sorted, depth-first walk gives the items sorted by path
+        for entry in entries:
+            if entry.name == ".git":
+                continue
+            relative_path = relative / entry.name
+            if entry.is_dir():
+                items.append((relative_path, True))
+                if not entry.is_symlink():
+                    walk(entry.path, relative_path)
+            elif entry.is_file():
+                items.append((relative_path, False))
+
+    walk(root, Path())
+    return items
+
+
+def map_file(f):
+    """
+    Map file read-only, hashing and decoding then work on the page cache without
+    copying the file. Small files are read, mmap would cost more for them.
+    """
+    if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+        return nullcontext(f.read())
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def content_hash(data):
+    """
+    Hash bytes for content comparison, returning the binary digest. Uses XXH3
+    when xxhash is available, SHA-256 otherwise. Only used to test equality,
+    not for security.
+    """
+    if xxhash is not None:
+        return xxhash.xxh3_64(data).digest()
+    return hashlib.sha256(data, usedforsecurity=False).digest()
 
 
-def sha256sum(file_path):
-    """Calculate the SHA-256 checksum of a file."""
+def file_hash(file_path):
+    """Calculate content_hash of a file, reading it in chunks."""
+    h = xxhash.xxh3_64() if xxhash is not None else hashlib.sha256(usedforsecurity=False)
     with open(file_path, "rb") as f:
-        return hashlib.sha256(f.read()).hexdigest()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def diff_line_count(a, b):
+    """
+    Count removed and added lines in a diff between two lists of lines,
+    without generating the diff text.
+    """
+    sm = difflib.SequenceMatcher(None, a, b)
+    return sum(
+        (i2 - i1) + (j2 - j1)
+        for tag, i1, i2, j1, j2 in sm.get_opcodes()
+        if tag != "equal"
+    )
+
+
+def line_bag_distance(counter, lines):
+    """
+    Count lines present in only one of the versions, ignoring the order of lines.
+    Counter holds the lines of the first version. This is a lower bound of
+    diff_line_count and much cheaper to compute.
+    """
+    other = Counter(lines)
+    return sum(((counter - other) + (other - counter)).values())
+
+
+def git_blob_sha(data):
+    """Calculate the id that git gives to a blob with the given content."""
+    h = hashlib.sha1(b"blob %d\0" % len(data), usedforsecurity=False)
+    h.update(data)
+    return h.hexdigest()
 
 
 def find_first_tag_for_commit(repo, commit):
@@ -38,172 +135,280 @@ def find_first_tag_for_commit(repo, commit):
     :param commit: GitPython Commit object
     :return: Tag object or None if no tag contains the commit
     """
-    tags = sorted(repo.tags, key=lambda t: t.commit.committed_date)
+    # single history walk in git instead of is_ancestor for every tag
+    containing = set(repo.git.tag("--contains", commit.hexsha).split())
+    tags = sorted(
+        (tag for tag in repo.tags if tag.name in containing),
+        key=lambda t: t.commit.committed_date,
+    )
 
-    # Iterate through all tags in the repository
-    first_tag = None
     for tag in tags:
-        if repo.is_ancestor(commit, tag.commit) or tag.commit == commit:
-            first_tag = tag
-            print("Tag with the commit:", tag)
+        print("Tag with the commit:", tag)
 
-    return first_tag
+    return tags[0] if tags else None
 
 
-def find_missing_items(archive_path, git_root, git_subfolder, files_to_check):
-    """Recursively find files/directories in archive that are not present in Git repository."""
+def git_item_is_dir(git_items, git_path, relative_path):
+    """
+    Look up the type of an item in the Git tree listing: True for a directory,
+    False for a file and None if missing. Symlinked directories are not walked,
+    items below them are looked up in the file system.
+    """
+    is_dir = git_items.get(relative_path)
+    if is_dir is None:
+        path = git_path / relative_path
+        if path.is_dir():
+            return True
+        if path.is_file():
+            return False
+    return is_dir
+
+
+def find_missing_items(archive_items, git_items, git_path, git_subfolder, files_to_check):
+    """Find files/directories in archive that are not present in Git repository."""
     print("=== Files/Directories in Archive Not in Git Repository ===")
 
-    for archive_item in archive_path.rglob("*"):
-        relative_path = archive_item.relative_to(archive_path)
-        if is_git_related(relative_path):
-            continue
-
+    for relative_path, is_dir in archive_items:
         if files_to_check is not None and str(relative_path) not in files_to_check:
             continue
 
-        git_equivalent = git_root / git_subfolder / relative_path
-
-        if archive_item.is_dir():
-            if not git_equivalent.is_dir():
+        git_is_dir = git_item_is_dir(git_items, git_path, relative_path)
+        if is_dir:
+            if not git_is_dir:
                 print_result(f"Missing directory: {git_subfolder / relative_path}")
-        elif archive_item.is_file():
-            if not git_equivalent.exists():
-                print_result(f"Missing file: {git_subfolder / relative_path}")
-                FilesMissing.append(relative_path)
+        elif git_is_dir is None:
+            print_result(f"Missing file: {git_subfolder / relative_path}")
+            FilesMissing.append(relative_path)
 
 
-def compare_files(archive_path, git_root, git_subfolder, useDiff, files_to_check):
+def is_ancestor(commit_order, ancestor, commit):
+    """
+    Check whether ancestor comes before or is the same as commit in the history
+    of HEAD, using commit positions from git rev-list --topo-order. Commits are
+    given by their hexsha.
+    """
+    if ancestor is None or commit is None:
+        return False
+    return commit_order[commit] <= commit_order[ancestor]
+
+
+def file_history(repo, git_path):
+    """
+    Get history of a file with a single git log, without walking commit trees.
+
+    :return: list of (commit, blob) hexsha tuples, newest first. Blob is None
+             if the file was removed in the commit.
+    """
+    out = repo.git.log(
+        "--raw", "-c", "--no-renames", "--no-abbrev", "--format=%H", "-z",
+        "HEAD", "--", git_path,
+    )
+    history = []
+    commit = None
+    tokens = iter(out.split("\0"))
+    for token in tokens:
+        token = token.lstrip("\n")
+        if token.startswith(":"):
+            # ":<modes> <blobs> <status>", the last blob is the file in this commit
+            blob = token.split()[-2]
+            next(tokens)  # path
+            history.append((commit, None if blob == NULL_SHA else blob))
+        elif token:
+            commit = token
+    return history
+
+
+def thread_repo(git_root):
+    """Get Repo object of the current thread, Repo objects are not thread-safe."""
+    repo = getattr(_thread_data, "repo", None)
+    if repo is None:
+        repo = _thread_data.repo = Repo(git_root)
+    return repo
+
+
+def compare_file(relative_file, archive_path, git_items, git_root, git_subfolder, useDiff, exactDiff):
+    """
+    Compare archive file with its version in Git repository and, if they differ,
+    look for the commit with the same content or, with useDiff, the smallest difference.
+    The difference is the number of lines present only in one of the versions, or
+    with exactDiff, the number of changed lines in the diff. Archive files that can't
+    be decoded are only looked up by content.
+
+    :return: None if the file is missing in Git or is the same, otherwise a tuple
+             (matching_commit, counter, min_diff_commit, min_diff_length, decoded)
+             with commits given by their hexsha. decoded is False if the archive
+             file couldn't be decoded for diff.
+    """
+    archive_file = archive_path / relative_file
+    git_file = git_root / git_subfolder / relative_file
+
+    # missing in Git or a directory there
+    if git_item_is_dir(git_items, git_root / git_subfolder, relative_file) is not False:
+        return None
+
+    with open(archive_file, "rb") as f, map_file(f) as archive_txt:
+        # files of different size can't match, no need to hash the files
+        if (
+            len(archive_txt) == git_file.stat().st_size
+            and content_hash(archive_txt) == file_hash(git_file)
+        ):
+            return None
+
+        # state of the archive file used for every commit below
+        archive_blob_sha = git_blob_sha(archive_txt)
+        decoded = True
+        if useDiff:
+            try:
+                archive_lines = str(archive_txt, "utf-8").splitlines(keepends=True)
+            except UnicodeDecodeError:
+                # only the matching commit is looked for
+                decoded = useDiff = False
+            else:
+                archive_line_counter = Counter(archive_lines)
+
+    repo = thread_repo(git_root)
+    file_commits = file_history(repo, (git_subfolder / relative_file).as_posix())
+
+    matching_commit = None
+    min_diff_commit = None
+    min_diff_length = None
+    compared_blobs = set()
+    counter = 0
+    for counter, (commit, blob_sha) in enumerate(file_commits, start=1):
+        if blob_sha is None:
+            # removed in this commit
+            continue
+        # blob id is the hash of its content, no need to read the blob
+        if blob_sha == archive_blob_sha:
+            matching_commit = commit
+            break
+        elif useDiff:
+            # the same content was already compared for a newer commit, it
+            # can't give a smaller difference
+            if blob_sha in compared_blobs:
+                continue
+            compared_blobs.add(blob_sha)
+            git_txt = repo.odb.stream(bytes.fromhex(blob_sha)).read()
+            git_lines = git_txt.decode().splitlines(keepends=True)
+            # at least 1 for files differing only in the order of lines
+            diff_length = max(1, line_bag_distance(archive_line_counter, git_lines))
+            if exactDiff:
+                # every line present in only one version is in the diff, skip
+                # the diff if it can't beat the current minimum
+                if min_diff_length is not None and diff_length >= min_diff_length:
+                    continue
+                diff_length = diff_line_count(git_lines, archive_lines)
+            if min_diff_length is None or min_diff_length > diff_length:
+                min_diff_commit = commit
+                min_diff_length = diff_length
+
+    return matching_commit, counter, min_diff_commit, min_diff_length, decoded
+
+
+def compare_files(archive_path, archive_items, git_items, git_root, git_subfolder, useDiff, exactDiff, files_to_check):
     """Compare files between an archive and a Git repository."""
     first_match_commit = None
     first_min_diff_commit = None
     repo = Repo(git_root)
 
+    # Position of each commit in the history of HEAD, newest first. Used instead
+    # of running git for every ancestry check.
+    commit_order = {
+        sha: index
+        for index, sha in enumerate(repo.git.rev_list("--topo-order", "HEAD").split())
+    }
+
     print("=== File Version Comparisons ===")
 
-    archive_files_list = list(archive_path.rglob("*"))
-    archive_files_list.sort()
+    # archive items are sorted already
+    relative_files = [
+        relative_file
+        for relative_file, is_dir in archive_items
+        if not is_dir
+        and (files_to_check is None or str(relative_file) in files_to_check)
+    ]
 
-    print(f"Files to compare: {len(archive_files_list)}")
+    print(f"Files to compare: {len(relative_files)}")
     last_progress_time = time.time()
     last_progress_index = 0
     progress_interval = 60
 
-    for aindex, archive_file in enumerate(archive_files_list):
-        if time.time() - last_progress_time > progress_interval:
-            dtleft = (len(archive_files_list)-aindex) / (aindex-last_progress_index) * progress_interval
-            print(f"-- Files left to compare {len(archive_files_list)-aindex}; estimated amount of minutes till the end: {dtleft/60.0:0.0f} minutes")
-            last_progress_time = time.time()
-            last_progress_index = aindex
-
-        if archive_file.is_file():
-            relative_file = archive_file.relative_to(archive_path)
-            if is_git_related(relative_file):
-                continue
-
-            if files_to_check is not None and str(relative_file) not in files_to_check:
+    # Files are compared in parallel, hashing and git are not holding GIL.
+    # Results are processed in the order of the files.
+    compare = partial(
+        compare_file,
+        archive_path=archive_path,
+        git_items=git_items,
+        git_root=git_root,
+        git_subfolder=git_subfolder,
+        useDiff=useDiff,
+        exactDiff=exactDiff,
+    )
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(compare, relative_files)
+        for aindex, (relative_file, result) in enumerate(zip(relative_files, results)):
+            # a result can arrive after the interval has passed, estimate only from compared files
+            if time.time() - last_progress_time > progress_interval and aindex > last_progress_index:
+                dtleft = (len(relative_files)-aindex) / (aindex-last_progress_index) * progress_interval
+                print(f"-- Files left to compare {len(relative_files)-aindex}; estimated amount of minutes till the end: {dtleft/60.0:0.0f} minutes")
+                last_progress_time = time.time()
+                last_progress_index = aindex
+
+            if result is None:
                 continue
 
-            git_file = git_root / git_subfolder / relative_file
-
-            if git_file.exists() and git_file.is_file():
-                with open(archive_file, "rb") as f:
-                    archive_txt = f.read()
-                    archive_sha = hashlib.sha256(archive_txt).hexdigest()
-                    if useDiff:
-                        try:
-                            archive_lines = archive_txt.decode().splitlines(keepends=True)
-                        except UnicodeDecodeError:
-                            print(f'Error while decoding archive file: {archive_file}. Skipping the file')
-                            break
-
-                if archive_sha != sha256sum(git_file):
-                    file_commits = list(
-                        repo.iter_commits(
-                            paths=str((git_subfolder / relative_file).as_posix())
-                        )
+            matching_commit, counter, min_diff_commit, min_diff_length, decoded = result
+            if not decoded:
+                print(f'Error while decoding archive file: {archive_path / relative_file}. Looking for matching commit only')
+            if matching_commit:
+                print(
+                    f"Older file: {git_subfolder / relative_file} -- matching commit: {matching_commit} ({counter} changes from head)"
+                )
+
+                # if commit_timestamp > first_match_timestamp:
+                if first_match_commit is None or is_ancestor(
+                    commit_order, first_match_commit, matching_commit
+                ):
+                    first_match_commit = matching_commit
+            else:
+                print_result(
+                    f"Differing file without match: {git_subfolder / relative_file}"
+                    + (
+                        f" -- closest commit: {min_diff_commit} (lines changed {min_diff_length})"
+                        if min_diff_commit is not None
+                        else ""
                     )
-
-                    matching_commit = None
-                    min_diff_commit = None
-                    min_diff_length = None
-                    for counter, commit in enumerate(file_commits, start=1):
-                        try:
-                            blob = commit.tree / str(
-                                (git_subfolder / relative_file).as_posix()
-                            )
-                        except:
-                            # probably removed in this commit
-                            continue
-                        git_txt = blob.data_stream.read()
-                        commit_sha = hashlib.sha256(git_txt).hexdigest()
-
-                        if archive_sha == commit_sha:
-                            matching_commit = commit
-
-                            # if commit_timestamp > first_match_timestamp:
-                            if first_match_commit is None or repo.is_ancestor(
-                                first_match_commit, commit
-                            ):
-                                first_match_commit = commit
-
-                            break
-                        elif useDiff:
-                            git_lines = git_txt.decode().splitlines(keepends=True)
-                            diff = difflib.unified_diff(
-                                git_lines,
-                                archive_lines,
-                                fromfile="InRepo",
-                                tofile="InArchive",
-                            )
-                            diff = "".join(diff)
-                            diff_length = len(diff.splitlines())
-                            if min_diff_length is None or min_diff_length > diff_length:
-                                min_diff_commit = commit
-                                min_diff_length = diff_length
-
-                    if matching_commit:
-                        print(
-                            f"Older file: {git_subfolder / relative_file} -- matching commit: {matching_commit.hexsha} ({counter} changes from head)"
-                        )
-                    else:
-                        print_result(
-                            f"Differing file without match: {git_subfolder / relative_file}"
-                            + (
-                                f" -- closest commit: {min_diff_commit.hexsha} (lines changed {min_diff_length})"
-                                if useDiff
-                                else ""
-                            )
-                        )
-                        FilesWithoutMatch.append(relative_file)
-                        if first_min_diff_commit is None or repo.is_ancestor(
-                            first_min_diff_commit, min_diff_commit
-                        ):
-                            first_min_diff_commit = min_diff_commit
+                )
+                FilesWithoutMatch.append(relative_file)
+                if first_min_diff_commit is None or is_ancestor(
+                    commit_order, first_min_diff_commit, min_diff_commit
+                ):
+                    first_min_diff_commit = min_diff_commit
 
     print()
     print(
         "Newest commit with matching files:",
-        first_match_commit.hexsha if first_match_commit else "None",
+        first_match_commit if first_match_commit else "None",
     )
     print(
         "Newest commit with smallest differences for non-matching files:",
-        first_min_diff_commit.hexsha if first_min_diff_commit else "None",
+        first_min_diff_commit if first_min_diff_commit else "None",
     )
     if first_match_commit is not None and first_min_diff_commit is not None:
-        if repo.is_ancestor(first_min_diff_commit, first_match_commit):
-            print(f"{first_match_commit.hexsha} is newer")
+        if is_ancestor(commit_order, first_min_diff_commit, first_match_commit):
+            print(f"{first_match_commit} is newer")
         else:
-            print(f"{first_min_diff_commit.hexsha} is newer")
+            print(f"{first_min_diff_commit} is newer")
 
 
 def find_git_root(path):
     """Find the root of the Git repository."""
-    current_path = path.resolve()
-    while current_path != current_path.parent:
-        if (current_path / ".git").exists():
-            return current_path
-        current_path = current_path.parent
+    current_path = os.path.realpath(path)
+    parent = os.path.dirname(current_path)
+    while current_path != parent:
+        if os.path.exists(os.path.join(current_path, ".git")):
+            return Path(current_path)
+        current_path, parent = parent, os.path.dirname(parent)
     raise InvalidGitRepositoryError(
         f"Could not find a Git repository at or above {path}"
     )
@@ -221,6 +426,11 @@ def main():
     )
     parser.add_argument("--files", default=None, help="Check only these files")
     parser.add_argument("--diff", default=False, action=argparse.BooleanOptionalAction)
+    parser.add_argument(
+        "--exact-diff",
+        action="store_true",
+        help="Measure difference by diff of the files instead of comparing their lines regardless of order",
+    )
     parser.add_argument("--copy-files", action="store_true")
     parser.add_argument("--make-merge-script", action="store_true")
     parser.add_argument("--merge-script-export-dir")
@@ -254,13 +464,17 @@ def main():
         print(f"Error: {e}")
         return
 
+    # Both trees are listed once, items are looked up in these listings
+    archive_items = walk_tree(archive_path)
+    git_items = dict(walk_tree(git_path))
+
     # Perform missing items check
-    find_missing_items(archive_path, git_root, git_subfolder, files_to_check)
+    find_missing_items(archive_items, git_items, git_path, git_subfolder, files_to_check)
 
     print()
 
     # Perform file comparison
-    compare_files(archive_path, git_root, git_subfolder, args.diff, files_to_check)
+    compare_files(archive_path, archive_items, git_items, git_root, git_subfolder, args.diff, args.exact_diff, files_to_check)
 
     print()
     print("\n".join(sorted(Messages)))
@@ -269,8 +483,8 @@ def main():
     if args.copy_files:
         print()
         print("Copy files\n")
-        fall = FilesWithoutMatch + FilesMissing
-        for f in sorted(fall):
+        # both lists are in archive order, merge them
+        for f in heapq.merge(FilesWithoutMatch, FilesMissing):
             print(archive_path / f, "-->", git_path / f)
             shutil.copy(archive_path / f, git_path / f)
 
@@ -1,16 +1,79 @@
 #!/usr/bin/env python
 
 import argparse
+from collections import Counter
 import difflib
 import hashlib
+import os
 import shutil
 import time
 from pathlib import Path
 from git import Repo, InvalidGitRepositoryError
 
+NULL_SHA = "0" * 40  # blob id of a removed file in git log --raw
 
-def closest_commit(archive_file, git_root, git_file_path):
-    """Find closest commit to a provided archive file"""
+
+def git_blob_sha(data):
+    """Calculate the id that git gives to a blob with the given content."""
+    h = hashlib.sha1(b"blob %d\0" % len(data), usedforsecurity=False)
+    h.update(data)
+    return h.hexdigest()
+
+
+def diff_line_count(a, b):
+    """
+    Count removed and added lines in a diff between two lists of lines,
+    without generating the diff text.
+    """
+    sm = difflib.SequenceMatcher(None, a, b)
+    return sum(
+        (i2 - i1) + (j2 - j1)
+        for tag, i1, i2, j1, j2 in sm.get_opcodes()
+        if tag != "equal"
+    )
+
+
+def line_bag_distance(counter, lines):
+    """
+    Count lines present in only one of the versions, ignoring the order of lines.
+    Counter holds the lines of the first version.
+    """
+    other = Counter(lines)
+    return sum(((counter - other) + (other - counter)).values())
+
+
+def file_history(repo, git_path):
+    """
+    Get history of a file with a single git log, without walking commit trees.
+
+    :return: list of (commit, blob) hexsha tuples, newest first. Blob is None
+             if the file was removed in the commit.
+    """
+    out = repo.git.log(
+        "--raw", "-c", "--no-renames", "--no-abbrev", "--format=%H", "-z",
+        "HEAD", "--", git_path,
+    )
+    history = []
+    commit = None
+    tokens = iter(out.split("\0"))
+    for token in tokens:
+        token = token.lstrip("\n")
+        if token.startswith(":"):
+            # ":<modes> <blobs> <status>", the last blob is the file in this commit
+            blob = token.split()[-2]
+            next(tokens)  # path
+            history.append((commit, None if blob == NULL_SHA else blob))
+        elif token:
+            commit = token
+    return history
+
+
+def closest_commit(archive_file, git_root, git_file_path, exact_diff=False):
+    """
+    Find closest commit to a provided archive file. The difference is the number
+    of lines present only in one of the versions, or with exact_diff, the number
+    of changed lines in the diff.
+    """
     repo = Repo(git_root)
 
     if not archive_file.is_file():
@@ -23,39 +86,38 @@ def closest_commit(archive_file, git_root, git_file_path):
     with open(archive_file, "rb") as f:
         archive_txt = f.read()
         archive_lines = archive_txt.decode().splitlines(keepends=True)
+    archive_line_counter = Counter(archive_lines)
+    archive_blob_sha = git_blob_sha(archive_txt)
 
     relative_file = git_file_path.relative_to(git_root)
     print(f'Checking file: {relative_file}\n')
 
-    file_commits = list(
-        repo.iter_commits(
-            paths=str((relative_file).as_posix())
-        )
-    )
+    git_path = relative_file.as_posix()
+    file_commits = file_history(repo, git_path)
 
     min_diff_commit = None
     min_diff_length = None
     min_diff_counter = None
-    for counter, commit in enumerate(file_commits):
-        try:
-            blob = commit.tree / str(
-                (relative_file).as_posix()
-            )
-        except:
-            # probably removed in this commit
+    for counter, (commit, blob_sha) in enumerate(file_commits):
+        if blob_sha is None:
+            # removed in this commit
             continue
 
-        git_txt = blob.data_stream.read()
-        git_lines = git_txt.decode().splitlines(keepends=True)
-
-        diff = difflib.unified_diff(
-            git_lines,
-            archive_lines,
-            fromfile="InRepo",
-            tofile="InArchive",
-        )
-        diff = "".join(diff)
-        diff_length = len(diff.splitlines())
+        # blob id is the hash of its content, no need to read the blob
+        if blob_sha == archive_blob_sha:
+            diff_length = 0
+        else:
+            git_txt = repo.odb.stream(bytes.fromhex(blob_sha)).read()
+            git_lines = git_txt.decode().splitlines(keepends=True)
+
+            # at least 1 for files differing only in the order of lines
+            diff_length = max(1, line_bag_distance(archive_line_counter, git_lines))
+            if exact_diff:
+                # every line present in only one version is in the diff, skip
+                # the diff if it can't beat the current minimum
+                if min_diff_length is not None and diff_length >= min_diff_length:
+                    continue
+                diff_length = diff_line_count(git_lines, archive_lines)
         if min_diff_length is None or min_diff_length > diff_length:
             min_diff_commit = commit
             min_diff_length = diff_length
@@ -66,22 +128,23 @@ def closest_commit(archive_file, git_root, git_file_path):
 
     if min_diff_length == 0:
         print(
-            f"Older file: {relative_file} -- matching commit: {min_diff_commit.hexsha} ({min_diff_counter} changes from head)"
+            f"Older file: {relative_file} -- matching commit: {min_diff_commit} ({min_diff_counter} changes from head)"
         )
     else:
         print(f"Differing file without match: {relative_file}")
-        print(f'Closest commit: {min_diff_commit.hexsha}')
+        print(f'Closest commit: {min_diff_commit}')
         print(f'Difference in lines: {min_diff_length}')
         print(f'Commits from current checkout: {min_diff_counter}')
 
 
 def find_git_root(path):
     """Find the root of the Git repository."""
-    current_path = path.resolve()
-    while current_path != current_path.parent:
-        if (current_path / ".git").exists():
-            return current_path
-        current_path = current_path.parent
+    current_path = os.path.realpath(path)
+    parent = os.path.dirname(current_path)
+    while current_path != parent:
+        if os.path.exists(os.path.join(current_path, ".git")):
+            return Path(current_path)
+        current_path, parent = parent, os.path.dirname(parent)
     raise InvalidGitRepositoryError(
         f"Could not find a Git repository at or above {path}"
     )
@@ -97,6 +160,11 @@ def main():
     parser.add_argument(
         "git_file_path", type=Path, help="Path to the Git repository file."
     )
+    parser.add_argument(
+        "--exact-diff",
+        action="store_true",
+        help="Measure difference by diff of the files instead of comparing their lines regardless of order",
+    )
 
     args = parser.parse_args()
 
@@ -110,7 +178,7 @@ def main():
         print(f"Error: {e}")
         return
 
-    closest_commit(archive_path, git_root, git_file_path)
+    closest_commit(archive_path, git_root, git_file_path, exact_diff=args.exact_diff)
 
 if __name__ == "__main__":
     main()
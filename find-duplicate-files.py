@@ -4,18 +4,22 @@ Compare files in two directories and report identical files.
 """
 
 import argparse
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import filecmp
+import os
 from pathlib import Path
 from typing import Set
 
 
-def calculate_file_hash(file_path: Path) -> str:
-    """Calculate SHA256 hash of a file."""
-    sha256_hash = hashlib.sha256()
-    with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+def same_content(file1: Path, file2: Path) -> bool:
+    """
+    Check whether two files have the same content. Files of different size
+    are rejected without reading, others are compared byte by byte, stopping
+    at the first difference.
+    """
+    if file1.stat().st_size != file2.stat().st_size:
+        return False
+    return filecmp.cmp(file1, file2, shallow=False)
 
 
 def get_relative_files(directory: Path) -> Set[Path]:
@@ -26,13 +30,25 @@ def get_relative_files(directory: Path) -> Set[Path]:
         raise ValueError(f"Not a directory: {directory}")
 
     files = set()
-    for f in directory.rglob("*"):
-        # Skip files inside .git directories
-        if ".git" in f.parts:
-            continue
-        if f.is_file():
-            files.add(f.relative_to(directory))
-    
+
+    def walk(folder: str, relative: str) -> None:
+        try:
+            with os.scandir(folder) as it:
+                entries = list(it)
+        except OSError:
+            # Skip unreadable directories
+            return
+        for entry in entries:
+            # Skip .git directories
+            if entry.name == ".git":
+                continue
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    walk(entry.path, relative + entry.name + os.sep)
+            elif entry.is_file():
+                files.add(Path(relative + entry.name))
+
+    walk(str(directory), "")
     return files
 
 def find_identical_files(dir1: Path, dir2: Path) -> list[str]:
@@ -53,16 +69,17 @@ def find_identical_files(dir1: Path, dir2: Path) -> list[str]:
     # Compare content of common files
     identical_files = []
     
-    for rel_path in common_files:
-        file1 = dir1 / rel_path
-        file2 = dir2 / rel_path
-        
+    # Files are compared in parallel, reading files releases the GIL
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [
+            (rel_path, executor.submit(same_content, dir1 / rel_path, dir2 / rel_path))
+            for rel_path in common_files
+        ]
+
+    for rel_path, future in futures:
         try:
-            # Compare file hashes
-            hash1 = calculate_file_hash(file1)
-            hash2 = calculate_file_hash(file2)
-            
-            if hash1 == hash2:
+            # Compare file contents
+            if future.result():
                 identical_files.append(str(rel_path))
             else:
                 different.add(rel_path)
@@ -4,12 +4,27 @@ import os
 def get_files_from_folder(folder, verbose=False):
     """Retrieve all file paths (relative to the folder) by walking through the folder recursively."""
     files = set()
-    for root, _, filenames in os.walk(folder):
-        for filename in filenames:
-            relative_path = os.path.join(root, filename)
-            files.add(relative_path)
-            if verbose: 
-                print('Checking for:', relative_path)
+
+    # os.scandir based walk, file types are taken from the cached DirEntry
+    def walk(root):
+        subfolders = []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        # as os.walk, symlinks to folders are not followed
+                        if not entry.is_symlink():
+                            subfolders.append(entry.path)
+                        continue
+                    files.add(entry.path)
+                    if verbose: 
+                        print('Checking for:', entry.path)
+        except OSError:
+            return  # unreadable folders are skipped, as by os.walk
+        for subfolder in subfolders:
+            walk(subfolder)
+
+    walk(folder)
     if verbose:
         print()
     return files
@@ -37,11 +52,7 @@ def get_files_from_txt(device_folders, duplicate=False):
                 line = line.strip()
                 if line and not line.startswith("#"):  # Ignore empty lines and commented out lines
                     for word in line.split(";"):
-                        w = word.strip()
-                        if w.startswith("-"):
-                            w = w[1:]
-                        if w.startswith("SYMLINK="):
-                            w = w[len("SYMLINK="):]
+                        w = word.strip().removeprefix("-").removeprefix("SYMLINK=")
                         
                         if duplicate and w in files:
                             print("Duplicate:", w)